@@ -32,6 +32,12 @@ queen_size_border = 100
 time_wait = 1
 
 
+def _fill_files_queue(fast5s_q, fast5_files, batch_size):
+    for i in np.arange(0, len(fast5_files), batch_size):
+        fast5s_q.put(fast5_files[i:(i+batch_size)])
+    return
+
+
 def _read_features_file(features_file, features_batch_q, f5_batch_num=20):
     print('read_features process {} starts'.format(os.getpid()))
     r_num = 0
@@ -429,10 +435,13 @@ def call_mods(input_path, model_path, result_file, kmer_len, cent_signals_len,
         normalize_method, motifs, mod_loc, methy_label, f5_batch_num, position_file = f5_args
 
     if os.path.isdir(input_path):
-        motif_seqs, chrom2len, fast5s_q, len_fast5s, positions = _extract_preprocess(input_path, is_recursive,
-                                                                                     motifs, is_dna,
-                                                                                     reference_path, f5_batch_num,
-                                                                                     position_file)
+        motif_seqs, chrom2len, fast5_files, positions = _extract_preprocess(input_path, is_recursive,
+                                                                            motifs, is_dna,
+                                                                            reference_path, position_file)
+        # fast5s_q = mp.Queue()
+        fast5s_q = Queue()
+        _fill_files_queue(fast5s_q, fast5_files, f5_batch_num)
+        len_fast5s = len(fast5_files)
 
         if is_gpu:
             _call_mods_from_fast5s_gpu(motif_seqs, chrom2len, fast5s_q, len_fast5s, corrected_group,
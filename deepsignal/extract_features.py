@@ -10,40 +10,60 @@ import sys
 import os
 import argparse
 import time
+import pickle
+import tempfile
+# fast5s are only read here, HDF5 (>=1.10) file locking just slows down opening them from
+# many processes. set before h5py is imported, as HDF5 may read it only once
+os.environ.setdefault("HDF5_USE_FILE_LOCKING", "FALSE")
 import h5py
-import random
 import numpy as np
 import multiprocessing as mp
-from .utils.process_utils import Queue
-from statsmodels import robust
 
 from .utils.process_utils import str2bool
 from .utils.process_utils import get_fast5s
-from .utils.process_utils import get_refloc_of_methysite_in_motif
+from .utils.process_utils import get_motif_pattern
+from .utils.process_utils import get_refloc_of_methysite_in_pattern
 from .utils.process_utils import get_motif_seqs
 
 from .utils.ref_reader import get_contig2len
 
 reads_group = 'Raw/Reads'
-queen_size_border = 1000
-time_wait = 1
 # MAX_LEGAL_SIGNAL_NUM = 800  # 800 only for 17-mer
 
 key_sep = "||"
+# buffer size of the features file, batches are written in one call each
+w_buffer_size = 1 << 20
 
+# 1 / norm.ppf(0.75), scales MAD to the std of normally distributed signals (as statsmodels.robust.mad)
+mad_scale = 1.4826022185056018
 
-def _get_label_raw(fast5_fn, correct_group, correct_subgroup):
-    try:
-        fast5_data = h5py.File(fast5_fn, 'r')
-    except IOError:
-        raise IOError('Error opening file. Likely a corrupted file.')
+_RNG = np.random.default_rng()
+
+
+def _reseed_rng():
+    # as the random module does, forked children must not draw the same samples as their parent
+    global _RNG
+    _RNG = np.random.default_rng()
 
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reseed_rng)
+
+# read-only args of _extract_features_of_fast5s, set once per worker process by _init_worker
+_WORKER_STATE = {}
+
+
+def _get_label_raw(fast5_data, correct_group, correct_subgroup):
+    """
+    :return: raw signals, and (starts, lengths, bases) arrays of the events
+    """
     # Get raw data
     try:
         raw_dat = list(fast5_data[reads_group].values())[0]
         # raw_attrs = raw_dat.attrs
-        # raw_dat = raw_dat['Signal'].value
-        raw_dat = raw_dat['Signal'][()]
+        signal_dataset = raw_dat['Signal']
+        raw_dat = np.empty(signal_dataset.shape, dtype=signal_dataset.dtype)
+        signal_dataset.read_direct(raw_dat)
     except Exception:
         raise RuntimeError('Raw data is not stored in Raw/Reads/Read_[read#] so '
                            'new segments cannot be identified.')
@@ -59,17 +79,15 @@ def _get_label_raw(fast5_fn, correct_group, correct_subgroup):
         corr_attrs = dict(list(event.attrs.items()))
         read_start_rel_to_raw = corr_attrs['read_start_rel_to_raw']
         # print('read_start_rel_to_raw: ',read_start_rel_to_raw)
-        starts = list(map(lambda x: x + read_start_rel_to_raw, event['start']))
     except KeyError:
-        # starts = list(map(lambda x: x, event['start']))
         raise KeyError('no read_start_rel_to_raw in event attributes')
 
-    lengths = event['length'].astype(np.int)
-    base = [x.decode("UTF-8") for x in event['base']]
-    assert len(starts) == len(lengths)
-    assert len(lengths) == len(base)
-    events = list(zip(starts, lengths, base))
-    return raw_dat, events
+    # read the compound dataset once, instead of once per field
+    event = event[()]
+    starts = event['start'].astype(np.int64) + read_start_rel_to_raw
+    lengths = event['length'].astype(np.int64)
+    bases = event['base']
+    return raw_dat, (starts, lengths, bases)
 
 
 def _get_alignment_attrs_of_each_strand(strand_path, h5obj):
@@ -118,98 +136,143 @@ def _get_readid_from_fast5(h5file):
     return read_id
 
 
-def _get_alignment_info_from_fast5(fast5_path, corrected_group='RawGenomeCorrected_000',
+def _get_alignment_info_from_fast5(h5file, corrected_group='RawGenomeCorrected_000',
                                    basecall_subgroup='BaseCalled_template'):
-    try:
-        h5file = h5py.File(fast5_path, mode='r')
-        corrgroup_path = '/'.join(['Analyses', corrected_group])
-
-        if '/'.join([corrgroup_path, basecall_subgroup, 'Alignment']) in h5file:
-            # fileprefix = os.path.basename(fast5_path).split('.fast5')[0]
-            readname = _get_readid_from_fast5(h5file)
-            strand, alignstrand, chrom, chrom_start = _get_alignment_attrs_of_each_strand('/'.join([corrgroup_path,
-                                                                                                    basecall_subgroup]),
-                                                                                          h5file)
-
-            h5file.close()
-            return readname, strand, alignstrand, chrom, chrom_start
-        else:
-            return '', '', '', '', ''
-    except IOError:
-        print("the {} can't be opened".format(fast5_path))
+    corrgroup_path = '/'.join(['Analyses', corrected_group])
+
+    if '/'.join([corrgroup_path, basecall_subgroup, 'Alignment']) in h5file:
+        # fileprefix = os.path.basename(fast5_path).split('.fast5')[0]
+        readname = _get_readid_from_fast5(h5file)
+        strand, alignstrand, chrom, chrom_start = _get_alignment_attrs_of_each_strand('/'.join([corrgroup_path,
+                                                                                                basecall_subgroup]),
+                                                                                      h5file)
+        return readname, strand, alignstrand, chrom, chrom_start
+    else:
         return '', '', '', '', ''
 
 
 def _normalize_signals(signals, normalize_method="mad"):
+    signals = np.asarray(signals, dtype=np.float32)
     if normalize_method == 'zscore':
-        sshift, sscale = np.mean(signals), np.float(np.std(signals))
+        sshift, sscale = signals.mean(), signals.std()
     elif normalize_method == 'mad':
-        sshift, sscale = np.median(signals), np.float(robust.mad(signals))
+        sshift = np.median(signals)
+        sscale = np.median(np.abs(signals - sshift)) * np.float32(mad_scale)
     else:
         raise ValueError("")
     norm_signals = (signals - sshift) / sscale
-    return np.around(norm_signals, decimals=6)
+    return np.around(norm_signals, decimals=6, out=norm_signals)
+
+
+def _get_signal_stats_of_events(norm_signals, starts, lengths):
+    """
+    mean/std of the signals of all events of a read, in one vectorized pass
+    instead of np.mean/np.std on each tiny slice
+    :param norm_signals: normalized signals of the read
+    :param starts: np.int64 array, start of each event in norm_signals
+    :param lengths: np.int64 array, signal num of each event, must be > 0
+    :return: signal_means, signal_stds (np.float32 arrays)
+    """
+    offsets = np.cumsum(lengths) - lengths
+    sig_idx = np.arange(offsets[-1] + lengths[-1]) + np.repeat(starts - offsets, lengths)
+    # gathered signals stay float32, only the per-event sums are accumulated in float64
+    event_signals = norm_signals[sig_idx]
+    signal_means = (np.add.reduceat(event_signals, offsets, dtype=np.float64) / lengths).astype(np.float32)
+    event_signals -= np.repeat(signal_means, lengths)
+    signal_stds = np.sqrt(np.add.reduceat(np.square(event_signals), offsets, dtype=np.float64) / lengths)
+    return signal_means, signal_stds.astype(np.float32)
 
 
 def _get_central_signals(signals_list, rawsignal_num=360):
     signal_lens = [len(x) for x in signals_list]
+    cent_signals = np.zeros(rawsignal_num, dtype=np.float32)
 
     if sum(signal_lens) < rawsignal_num:
-        # real_signals = sum(signals_list, [])
-        real_signals = np.concatenate(signals_list)
-        cent_signals = np.append(real_signals, np.array([0] * (rawsignal_num - len(real_signals))))
+        # signals of all bases, padded with 0s at the end
+        cursor = 0
+        for signals in signals_list:
+            cent_signals[cursor:(cursor + len(signals))] = signals
+            cursor += len(signals)
     else:
         mid_loc = int((len(signals_list) - 1) / 2)
-        mid_base_len = len(signals_list[mid_loc])
+        mid_base_len = signal_lens[mid_loc]
 
         if mid_base_len >= rawsignal_num:
             allcentsignals = signals_list[mid_loc]
-            cent_signals = [allcentsignals[x] for x in sorted(random.sample(range(len(allcentsignals)),
-                                                                            rawsignal_num))]
+            sample_idx = _RNG.choice(len(allcentsignals), rawsignal_num, replace=False)
+            sample_idx.sort()
+            cent_signals[:] = allcentsignals[sample_idx]
         else:
             left_len = (rawsignal_num - mid_base_len) // 2
             right_len = rawsignal_num - left_len
 
-            # left_signals = sum(signals_list[:mid_loc], [])
-            # right_signals = sum(signals_list[mid_loc:], [])
-            left_signals = np.concatenate(signals_list[:mid_loc])
-            right_signals = np.concatenate(signals_list[mid_loc:])
+            left_signals_len = sum(signal_lens[:mid_loc])
+            right_signals_len = sum(signal_lens[mid_loc:])
 
-            if left_len > len(left_signals):
-                right_len = right_len + left_len - len(left_signals)
-                left_len = len(left_signals)
-            elif right_len > len(right_signals):
-                left_len = left_len + right_len - len(right_signals)
-                right_len = len(right_signals)
+            if left_len > left_signals_len:
+                right_len = right_len + left_len - left_signals_len
+                left_len = left_signals_len
+            elif right_len > right_signals_len:
+                left_len = left_len + right_len - right_signals_len
+                right_len = right_signals_len
 
             assert (right_len + left_len == rawsignal_num)
-            if left_len == 0:
-                cent_signals = right_signals[:right_len]
-            else:
-                cent_signals = np.append(left_signals[-left_len:], right_signals[:right_len])
+            # the last left_len signals left of the mid base, filled backwards
+            cursor = left_len
+            for signals in reversed(signals_list[:mid_loc]):
+                if cursor == 0:
+                    break
+                fill_len = min(cursor, len(signals))
+                cent_signals[(cursor - fill_len):cursor] = signals[(len(signals) - fill_len):]
+                cursor -= fill_len
+            # the first right_len signals from the mid base on
+            cursor = left_len
+            for signals in signals_list[mid_loc:]:
+                if cursor == rawsignal_num:
+                    break
+                fill_len = min(rawsignal_num - cursor, len(signals))
+                cent_signals[cursor:(cursor + fill_len)] = signals[:fill_len]
+                cursor += fill_len
     return cent_signals
 
 
-def _get_scaling_of_a_read(fast5fp):
+def _get_scaling_of_a_read(h5file):
     global_key = "UniqueGlobalKey/"
+    channel_info = dict(list(h5file[global_key + 'channel_id'].attrs.items()))
+    digi = channel_info['digitisation']
+    parange = channel_info['range']
+    offset = channel_info['offset']
+    scaling = parange / digi
+    # print(scaling, offset)
+    return scaling, offset
+
+
+def _read_fast5_all(fast5_fp, corrected_group, basecall_subgroup):
+    """
+    read everything needed of a read from its fast5, opening the file only once
+    :return: raw_signal, events (starts, lengths, bases), (scaling, offset),
+             (readname, strand, alignstrand, chrom, chrom_start)
+    """
     try:
-        h5file = h5py.File(fast5fp, mode='r')
-        channel_info = dict(list(h5file[global_key + 'channel_id'].attrs.items()))
-        digi = channel_info['digitisation']
-        parange = channel_info['range']
-        offset = channel_info['offset']
-        scaling = parange / digi
-
-        h5file.close()
-        # print(scaling, offset)
-        return scaling, offset
+        h5file = h5py.File(fast5_fp, mode='r')
     except IOError:
-        print("the {} can't be opened".format(fast5fp))
-        return None, None
+        raise IOError('Error opening file. Likely a corrupted file.')
+    with h5file:
+        # check alignment first, so that unaligned reads skip reading signals and events
+        alignment_info = _get_alignment_info_from_fast5(h5file, corrected_group, basecall_subgroup)
+        if alignment_info[3] == '':
+            raise RuntimeError('alignment not found.')
+        raw_signal, events = _get_label_raw(h5file, corrected_group, basecall_subgroup)
+        scaling_info = _get_scaling_of_a_read(h5file)
+    return raw_signal, events, scaling_info, alignment_info
 
 
 def _rescale_signals(rawsignals, scaling, offset):
-    return np.array(scaling * (rawsignals + offset), dtype=np.float)
+    # float32 from here on, the features are written with 6 decimals anyway
+    signals = rawsignals.astype(np.float32)
+    signals += np.float32(offset)
+    signals *= np.float32(scaling)
+    return signals
 
 
 def _extract_features(fast5s, corrected_group, basecall_subgroup, normalize_method,
@@ -218,43 +281,48 @@ def _extract_features(fast5s, corrected_group, basecall_subgroup, normalize_meth
     if kmer_len % 2 == 0:
         raise ValueError("kmer_len must be odd")
     num_bases = (kmer_len - 1) // 2
+    motif_pattern = get_motif_pattern(motif_seqs)
+    return _extract_features_of_fast5s(fast5s, corrected_group, basecall_subgroup, normalize_method,
+                                       motif_pattern, methyloc, chrom2len, num_bases, raw_signals_len,
+                                       methy_label, positions)
 
+
+def _extract_features_of_fast5s(fast5s, corrected_group, basecall_subgroup, normalize_method,
+                                motif_pattern, methyloc, chrom2len, num_bases, raw_signals_len,
+                                methy_label, positions):
     features_list = []
     error = 0
     for fast5_fp in fast5s:
         try:
-            raw_signal, events = _get_label_raw(fast5_fp, corrected_group, basecall_subgroup)
-
-            scaling, offset = _get_scaling_of_a_read(fast5_fp)
-            if scaling is None:
-                continue
-            else:
-                raw_signal = _rescale_signals(raw_signal, scaling, offset)
-
-            norm_signals = _normalize_signals(raw_signal, normalize_method)
-            genomeseq, signal_list = "", []
-            for e in events:
-                genomeseq += str(e[2])
-                signal_list.append(norm_signals[e[0]:(e[0] + e[1])])
-
-            readname, strand, alignstrand, chrom, \
-                chrom_start = _get_alignment_info_from_fast5(fast5_fp, corrected_group, basecall_subgroup)
-
+            raw_signal, events, scaling_info, alignment_info = _read_fast5_all(fast5_fp, corrected_group,
+                                                                               basecall_subgroup)
+            readname, strand, alignstrand, chrom, chrom_start = alignment_info
             try:
                 chromlen = chrom2len[chrom] if chrom2len is not None else None
             except KeyError:
                 print("warning - chrom_name in fast5 not in provided reference genome!")
                 chromlen = None
 
+            raw_signal = _rescale_signals(raw_signal, *scaling_info)
+
+            norm_signals = _normalize_signals(raw_signal, normalize_method)
+            event_starts, event_lens, event_bases = events
+            # bases are single-byte chars, decode them all at once
+            genomeseq = event_bases.tobytes().decode("UTF-8")
+            event_means, event_stds = _get_signal_stats_of_events(norm_signals, event_starts, event_lens)
+
             # tsite_locs = []
             # for mseq in motif_seqs:
             #     tsite_locs += get_refloc_of_methysite_in_motif(genomeseq, mseq, methyloc)
-            tsite_locs = get_refloc_of_methysite_in_motif(genomeseq, set(motif_seqs), methyloc)
+            tsite_locs = get_refloc_of_methysite_in_pattern(genomeseq, motif_pattern, methyloc)
 
+            seq_len = len(genomeseq)
+            # python ints, cheaper to slice norm_signals with than numpy scalars
+            event_starts_list, event_lens_list = event_starts.tolist(), event_lens.tolist()
             for loc_in_read in tsite_locs:
-                if num_bases <= loc_in_read < len(genomeseq) - num_bases:
+                if num_bases <= loc_in_read < seq_len - num_bases:
                     if alignstrand == '-':
-                        pos = chrom_start + len(genomeseq) - 1 - loc_in_read
+                        pos = chrom_start + seq_len - 1 - loc_in_read
                         pos_in_strand = chromlen - 1 - pos if chromlen is not None else -1
                     else:
                         pos = chrom_start + loc_in_read
@@ -263,15 +331,18 @@ def _extract_features(fast5s, corrected_group, basecall_subgroup, normalize_meth
                     if (positions is not None) and (key_sep.join([chrom, str(pos), alignstrand]) not in positions):
                         continue
 
-                    k_mer = genomeseq[(loc_in_read - num_bases):(loc_in_read + num_bases + 1)]
-                    k_signals = signal_list[(loc_in_read - num_bases):(loc_in_read + num_bases + 1)]
+                    kmer_s, kmer_e = loc_in_read - num_bases, loc_in_read + num_bases + 1
+                    k_mer = genomeseq[kmer_s:kmer_e]
+                    k_signals = [norm_signals[e_start:(e_start + e_len)]
+                                 for e_start, e_len in zip(event_starts_list[kmer_s:kmer_e],
+                                                           event_lens_list[kmer_s:kmer_e])]
 
-                    signal_lens = [len(x) for x in k_signals]
+                    signal_lens = event_lens[kmer_s:kmer_e]
                     # if sum(signal_lens) > MAX_LEGAL_SIGNAL_NUM:
                     #     continue
 
-                    signal_means = [np.mean(x) for x in k_signals]
-                    signal_stds = [np.std(x) for x in k_signals]
+                    signal_means = event_means[kmer_s:kmer_e]
+                    signal_stds = event_stds[kmer_s:kmer_e]
 
                     cent_signals = _get_central_signals(k_signals, raw_signals_len)
 
@@ -286,103 +357,126 @@ def _extract_features(fast5s, corrected_group, basecall_subgroup, normalize_meth
     return features_list, error
 
 
-def _features_to_str(features):
-    """
+def _floats_to_text(values):
+    # one %-format call for the whole array, instead of one str() per value
+    return b','.join([b'%.6f'] * len(values)) % tuple(values.tolist())
+
 
+def _features_to_bytes(features):
+    """
+    format features as a line of the features file, built as bytes directly so that
+    the writer doesn't need to encode it again
     :param features: a tuple
     :return:
     """
     chrom, pos, alignstrand, pos_in_strand, readname, strand, k_mer, signal_means, signal_stds, \
         signal_lens, cent_signals, methy_label = features
-    means_text = ','.join([str(x) for x in np.around(signal_means, decimals=6)])
-    stds_text = ','.join([str(x) for x in np.around(signal_stds, decimals=6)])
-    signal_len_text = ','.join([str(x) for x in signal_lens])
-    cent_signals_text = ','.join([str(x) for x in cent_signals])
-
-    return "\t".join([chrom, str(pos), alignstrand, str(pos_in_strand), readname, strand, k_mer, means_text,
-                      stds_text, signal_len_text, cent_signals_text, str(methy_label)])
-
-
-def _fill_files_queue(fast5s_q, fast5_files, batch_size):
-    for i in np.arange(0, len(fast5_files), batch_size):
-        fast5s_q.put(fast5_files[i:(i+batch_size)])
-    return
-
-
-def get_a_batch_features_str(fast5s_q, featurestr_q, errornum_q,
-                             corrected_group, basecall_subgroup, normalize_method,
-                             motif_seqs, methyloc, chrom2len, kmer_len, raw_signals_len, methy_label,
-                             positions):
-    while True:
-        fast5s = fast5s_q.get()
-        if fast5s == "kill":
-            fast5s_q.put("kill")
-            break
-        features_list, error_num = _extract_features(fast5s, corrected_group, basecall_subgroup,
-                                                     normalize_method, motif_seqs, methyloc,
-                                                     chrom2len, kmer_len, raw_signals_len, methy_label,
-                                                     positions)
-        features_str = []
-        for features in features_list:
-            features_str.append(_features_to_str(features))
-
-        errornum_q.put(error_num)
-        featurestr_q.put(features_str)
-        while featurestr_q.qsize() > queen_size_border:
-            time.sleep(time_wait)
-    # print("get out of while loop in get_feature_str")
-
-
-def _write_featurestr_to_file(write_fp, featurestr_q):
-    with open(write_fp, 'w') as wf:
-        while True:
-            # during test, it's ok without the sleep(time_wait)
-            if featurestr_q.empty():
-                time.sleep(time_wait)
-                continue
-            features_str = featurestr_q.get()
-            if features_str == "kill":
-                break
-            for one_features_str in features_str:
-                wf.write(one_features_str + "\n")
-            wf.flush()
-
-
-def _write_featurestr_to_dir(write_dir, featurestr_q, w_batch_num):
+    means_text = _floats_to_text(signal_means)
+    stds_text = _floats_to_text(signal_stds)
+    signal_len_text = b','.join([b'%d'] * len(signal_lens)) % tuple(signal_lens.tolist())
+    cent_signals_text = _floats_to_text(cent_signals)
+
+    return b"\t".join([chrom.encode(), b'%d' % pos, alignstrand.encode(), b'%d' % pos_in_strand,
+                       readname.encode(), strand.encode(), k_mer.encode(), means_text,
+                       stds_text, signal_len_text, cent_signals_text, b'%d' % methy_label])
+
+
+def _init_worker(corrected_group, basecall_subgroup, normalize_method, motif_seqs, methyloc,
+                 chrom2len, kmer_len, raw_signals_len, methy_label, positions):
+    # the motif pattern and num_bases are the same for all batches, prepare them once per worker.
+    # kmer_len is already checked in extract_features, an error here would make the pool respawn workers
+    _WORKER_STATE.update(corrected_group=corrected_group, basecall_subgroup=basecall_subgroup,
+                         normalize_method=normalize_method, motif_pattern=get_motif_pattern(motif_seqs),
+                         methyloc=methyloc, chrom2len=chrom2len, num_bases=(kmer_len - 1) // 2,
+                         raw_signals_len=raw_signals_len, methy_label=methy_label, positions=positions)
+
+
+def _dump_worker_state(worker_args):
+    """
+    pickle the args of _init_worker into a temp file once, for workers which don't inherit
+    the parent's memory (non-fork start methods). those workers load the file in
+    _load_worker_state, instead of the parent pickling chrom2len/positions for each worker.
+    """
+    fd, state_fp = tempfile.mkstemp(prefix="deepsignal_extract.", suffix=".pkl")
+    with os.fdopen(fd, 'wb') as wf:
+        pickle.dump(worker_args, wf, protocol=pickle.HIGHEST_PROTOCOL)
+    return state_fp
+
+
+def _load_worker_state(state_fp):
+    with open(state_fp, 'rb') as rf:
+        _init_worker(*pickle.load(rf))
+
+
+def _extract_features_one_batch(fast5s):
+    features_list, error_num = _extract_features_of_fast5s(fast5s, **_WORKER_STATE)
+    features_lines = []
+    for features in features_list:
+        features_lines.append(_features_to_bytes(features))
+    return features_lines, error_num
+
+
+def _write_featurestr_to_file(write_fp, features_results):
+    errornum_sum = 0
+    with open(write_fp, 'wb', buffering=w_buffer_size) as wf:
+        for features_lines, error_num in features_results:
+            errornum_sum += error_num
+            if len(features_lines) > 0:
+                wf.write(b"\n".join(features_lines) + b"\n")
+    return errornum_sum
+
+
+def _write_featurestr_to_dir(write_dir, features_results, w_batch_num):
     if os.path.exists(write_dir):
         if os.path.isfile(write_dir):
             raise FileExistsError("{} already exists as a file, please use another write_dir".format(write_dir))
     else:
         os.makedirs(write_dir)
 
+    errornum_sum = 0
     file_count = 0
-    wf = open("/".join([write_dir, str(file_count) + ".tsv"]), "w")
+    wf = open("/".join([write_dir, str(file_count) + ".tsv"]), "wb", buffering=w_buffer_size)
     batch_count = 0
-    while True:
-        # during test, it's ok without the sleep(time_wait)
-        if featurestr_q.empty():
-            time.sleep(time_wait)
-            continue
-        features_str = featurestr_q.get()
-        if features_str == "kill":
-            break
-
+    for features_lines, error_num in features_results:
+        errornum_sum += error_num
         if batch_count >= w_batch_num:
-            wf.flush()
             wf.close()
             file_count += 1
-            wf = open("/".join([write_dir, str(file_count) + ".tsv"]), "w")
+            wf = open("/".join([write_dir, str(file_count) + ".tsv"]), "wb", buffering=w_buffer_size)
             batch_count = 0
-        for one_features_str in features_str:
-            wf.write(one_features_str + "\n")
+        if len(features_lines) > 0:
+            wf.write(b"\n".join(features_lines) + b"\n")
         batch_count += 1
+    wf.close()
+    return errornum_sum
 
 
-def _write_featurestr(write_fp, featurestr_q, w_batch_num=10000, is_dir=False):
+def _write_featurestr(write_fp, features_results, w_batch_num=10000, is_dir=False):
+    """
+    write the features lines of each batch to write_fp as the results come
+    :param features_results: iterable of (features_lines (bytes), error_num) of each batch
+    :return: total number of failed fast5 files
+    """
     if is_dir:
-        _write_featurestr_to_dir(write_fp, featurestr_q, w_batch_num)
+        return _write_featurestr_to_dir(write_fp, features_results, w_batch_num)
     else:
-        _write_featurestr_to_file(write_fp, featurestr_q)
+        return _write_featurestr_to_file(write_fp, features_results)
+
+
+def _get_allowed_nproc(nproc):
+    """
+    clamp nproc to the cpus this process is allowed to run on (e.g. limited by taskset/cgroups
+    on shared nodes), over-subscription slows every worker down.
+    each worker reads fast5s through its own HDF5 library, so the speedup is bounded by
+    the I/O bandwidth rather than by nproc.
+    """
+    try:
+        allowed_cpu_num = len(os.sched_getaffinity(0))
+    except AttributeError:
+        allowed_cpu_num = mp.cpu_count()
+    if nproc > allowed_cpu_num:
+        print("only {} cpus are available, nproc is set to {}..".format(allowed_cpu_num, allowed_cpu_num))
+    return max(1, min(nproc, allowed_cpu_num))
 
 
 def _read_position_file(position_file):
@@ -394,8 +488,7 @@ def _read_position_file(position_file):
     return postions
 
 
-def _extract_preprocess(fast5_dir, is_recursive, motifs, is_dna, reference_path, f5_batch_num,
-                        position_file):
+def _extract_preprocess(fast5_dir, is_recursive, motifs, is_dna, reference_path, position_file):
 
     fast5_files = get_fast5s(fast5_dir, is_recursive)
     print("{} fast5 files in total..".format(len(fast5_files)))
@@ -414,11 +507,7 @@ def _extract_preprocess(fast5_dir, is_recursive, motifs, is_dna, reference_path,
     if position_file is not None:
         positions = _read_position_file(position_file)
 
-    # fast5s_q = mp.Queue()
-    fast5s_q = Queue()
-    _fill_files_queue(fast5s_q, fast5_files, f5_batch_num)
-
-    return motif_seqs, chrom2len, fast5s_q, len(fast5_files), positions
+    return motif_seqs, chrom2len, fast5_files, positions
 
 
 def extract_features(fast5_dir, is_recursive, reference_path, is_dna,
@@ -427,54 +516,45 @@ def extract_features(fast5_dir, is_recursive, reference_path, is_dna,
                      motifs, methyloc, kmer_len, raw_signals_len, methy_label,
                      position_file, w_is_dir, w_batch_num):
     start = time.time()
+    if kmer_len % 2 == 0:
+        raise ValueError("kmer_len must be odd")
 
-    motif_seqs, chrom2len, fast5s_q, len_fast5s, positions = _extract_preprocess(fast5_dir, is_recursive,
-                                                                                 motifs, is_dna, reference_path,
-                                                                                 batch_size, position_file)
-
-    # featurestr_q = mp.Queue()
-    # errornum_q = mp.Queue()
-    featurestr_q = Queue()
-    errornum_q = Queue()
-
-    featurestr_procs = []
-    if nproc > 1:
-        nproc -= 1
-    fast5s_q.put("kill")
-    for _ in range(nproc):
-        p = mp.Process(target=get_a_batch_features_str, args=(fast5s_q, featurestr_q, errornum_q,
-                                                              corrected_group, basecall_subgroup,
-                                                              normalize_method, motif_seqs,
-                                                              methyloc, chrom2len, kmer_len, raw_signals_len,
-                                                              methy_label, positions))
-        p.daemon = True
-        p.start()
-        featurestr_procs.append(p)
-
-    print("write_process started..")
-    p_w = mp.Process(target=_write_featurestr, args=(write_fp, featurestr_q, w_batch_num, w_is_dir))
-    p_w.daemon = True
-    p_w.start()
-
-    errornum_sum = 0
-    while True:
-        # print("killing feature_p")
-        running = any(p.is_alive() for p in featurestr_procs)
-        while not errornum_q.empty():
-            errornum_sum += errornum_q.get()
-        if not running:
-            break
-
-    for p in featurestr_procs:
-        p.join()
-
-    print("finishing the write_process..")
-    featurestr_q.put("kill")
-
-    p_w.join()
+    motif_seqs, chrom2len, fast5_files, positions = _extract_preprocess(fast5_dir, is_recursive,
+                                                                        motifs, is_dna, reference_path,
+                                                                        position_file)
+    fast5s_batches = [fast5_files[i:(i + batch_size)] for i in range(0, len(fast5_files), batch_size)]
+
+    nproc = _get_allowed_nproc(nproc)
+    worker_args = (corrected_group, basecall_subgroup, normalize_method, motif_seqs, methyloc,
+                   chrom2len, kmer_len, raw_signals_len, methy_label, positions)
+    # fork explicitly on linux, whatever the default start method of the python version is, workers
+    # only get fast5 paths, so no open h5 handles are duplicated. fork is unsafe on macOS.
+    if sys.platform.startswith('linux'):
+        mp_ctx = mp.get_context('fork')
+    else:
+        mp_ctx = mp.get_context('spawn')
+        print("warning - workers are started by spawn, each of them re-imports deepsignal (numpy, h5py) "
+              "and reloads the extraction args..")
+    state_fp = None
+    if mp_ctx.get_start_method() == 'fork':
+        # forked workers inherit worker_args from the parent's memory, nothing is pickled
+        pool = mp_ctx.Pool(nproc, initializer=_init_worker, initargs=worker_args)
+    else:
+        state_fp = _dump_worker_state(worker_args)
+        pool = mp_ctx.Pool(nproc, initializer=_load_worker_state, initargs=(state_fp,))
+    try:
+        print("extracting and writing features..")
+        errornum_sum = _write_featurestr(write_fp, pool.imap_unordered(_extract_features_one_batch, fast5s_batches,
+                                                                       chunksize=1),
+                                         w_batch_num, w_is_dir)
+        pool.close()
+        pool.join()
+    finally:
+        if state_fp is not None:
+            os.remove(state_fp)
 
     print("%d of %d fast5 files failed..\n"
-          "extract_features costs %.1f seconds.." % (errornum_sum, len_fast5s,
+          "extract_features costs %.1f seconds.." % (errornum_sum, len(fast5_files),
                                                      time.time() - start))
 
 
@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 import fnmatch
+import itertools
 import os
+import re
 import random
 import multiprocessing
 import multiprocessing.queues
@@ -92,6 +94,26 @@ def complement_seq(base_seq, seq_type="DNA"):
 #     return sites
 
 
+def get_motif_pattern(motifset):
+    """
+    compile all motif seqs into one regex, the lookahead makes overlapped motifs found too
+    :param motifset: motif seqs, IUPAC alphabets already converted
+    :return: compiled pattern for get_refloc_of_methysite_in_pattern
+    """
+    return re.compile("(?=(?:{}))".format("|".join([re.escape(x) for x in sorted(set(motifset))])))
+
+
+def get_refloc_of_methysite_in_pattern(seqstr, motif_pattern, methyloc_in_motif=0):
+    """
+
+    :param seqstr:
+    :param motif_pattern: from get_motif_pattern()
+    :param methyloc_in_motif: 0-based
+    :return:
+    """
+    return [m.start() + methyloc_in_motif for m in motif_pattern.finditer(seqstr)]
+
+
 def get_refloc_of_methysite_in_motif(seqstr, motifset, methyloc_in_motif=0):
     """
 
@@ -100,38 +122,12 @@ def get_refloc_of_methysite_in_motif(seqstr, motifset, methyloc_in_motif=0):
     :param methyloc_in_motif: 0-based
     :return:
     """
-    motifset = set(motifset)
-    strlen = len(seqstr)
-    motiflen = len(list(motifset)[0])
-    sites = []
-    for i in range(0, strlen - motiflen + 1):
-        if seqstr[i:i + motiflen] in motifset:
-            sites.append(i+methyloc_in_motif)
-    return sites
+    return get_refloc_of_methysite_in_pattern(seqstr, get_motif_pattern(motifset), methyloc_in_motif)
 
 
 def _convert_motif_seq(ori_seq, is_dna=True):
-    outbases = []
-    for bbase in ori_seq:
-        if is_dna:
-            outbases.append(iupac_alphabets[bbase])
-        else:
-            outbases.append(iupac_alphabets_rna[bbase])
-
-    def recursive_permute(bases_list):
-        if len(bases_list) == 1:
-            return bases_list[0]
-        elif len(bases_list) == 2:
-            pseqs = []
-            for fbase in bases_list[0]:
-                for sbase in bases_list[1]:
-                    pseqs.append(fbase + sbase)
-            return pseqs
-        else:
-            pseqs = recursive_permute(bases_list[1:])
-            pseq_list = [bases_list[0], pseqs]
-            return recursive_permute(pseq_list)
-    return recursive_permute(outbases)
+    alphabets = iupac_alphabets if is_dna else iupac_alphabets_rna
+    return [''.join(bases) for bases in itertools.product(*[alphabets[bbase] for bbase in ori_seq])]
 
 
 def get_motif_seqs(motifs, is_dna=True):
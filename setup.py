@@ -56,7 +56,6 @@ setup(
     # TODO: but it looks fine when using pip
     # install_requires=['numpy>=1.15.3',
     #                   'h5py>=2.8.0',
-    #                   'statsmodels>=0.9.0',
     #                   'scikit-learn>=0.20.1',
     #                   ],
     install_requires=required,